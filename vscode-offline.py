@@ -2,6 +2,7 @@
 # Download the last Visual Studio Code extension compatible with a given version
 
 import argparse
+import gzip
 import hashlib
 import json
 import logging
@@ -9,17 +10,40 @@ import os
 import re
 import subprocess  # nosec B404
 import sys
+import threading
 import typing as t
 import zipfile
 import zlib
 from collections import defaultdict
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from datetime import datetime
 from email.utils import parsedate_to_datetime
-from io import StringIO
+from functools import lru_cache
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # faster JSON parser and serializer for the (big) extension query responses, if available
+    import orjson  # type: ignore[import-not-found]
+
+    def json_loads(data: bytes) -> t.Any:
+        return orjson.loads(data)
+
+    def json_dumps(obj: t.Any) -> bytes:
+        return orjson.dumps(obj)
+
+except ImportError:
+
+    def json_loads(data: bytes) -> t.Any:
+        return json.loads(data)
+
+    def json_dumps(obj: t.Any) -> bytes:
+        return json.dumps(obj).encode()
+
 
 BRIGHT_GREEN, FADE, GREEN, RESET = (
     ("\033[1;32m", "\033[2m", "\033[32m", "\033[0m") if sys.stdout.isatty() else ("", "", "", "")
@@ -49,6 +73,47 @@ PLATFORMS = {
     "win32-x64": True,
 }
 
+# number of concurrent downloads (too many may trigger HTTP 429 from the servers)
+DOWNLOAD_WORKERS = 5
+
+# set to interrupt the downloads in progress
+DOWNLOAD_CANCELLED = threading.Event()
+
+# number of VSIX manifests read concurrently (file reads and zlib release the GIL)
+MANIFEST_WORKERS = 8
+
+# shared HTTP session: connections are kept alive and reused across requests
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = "vscode-offline"
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+    ),
+)
+
+
+# maximum number of extensions in a filter of the extension query
+QUERY_BATCH_SIZE = 100
+
+
+# configuration file parsing
+_RE_SECTION = re.compile(r"(\w+_extensions)=\((.+?)\)", re.DOTALL)
+_RE_INVENTORY = re.compile(r"\b\w+_extensions=\((?:.+?)\)", re.DOTALL)
+_RE_VSIX_VERSION = re.compile(r"\-(\d+)\.(\d+)\.(\d+)\.vsix$")
+_RE_PLATFORM_STRIP = re.compile(r"-(?:\$\{arch\}|" + "|".join(map(re.escape, PLATFORMS)) + ")")
+_RE_VERSION = re.compile(r"\bversion=(.+)\b")
+_RE_COMMIT = re.compile(r"\bcommit=(.+)\b")
+_RE_CHANNEL = re.compile(r"\bchannel=(.+)\b")
+
+# VSCode version from the download link
+_RE_CODE_URL = re.compile(r"/(\w+)/([a-f0-9]{40})/VSCode-win32-x64-([\d.]+).zip")
+
+# fraction of second of an ISO 8601 date
+_RE_ISO_FRACTION = re.compile(r"\.(\d+)")
+
 
 # constants from vscode extension API
 # https://github.com/microsoft/vscode/blob/main/src/vs/platform/extensionManagement/common/extensionGalleryService.ts
@@ -83,16 +148,82 @@ class Flags:
     IncludeNameConflictInfo = 0x8000
 
 
-def get_property(version, name):
-    if "properties" not in version:
-        # print(version)
-        return
-    for property in version.get("properties", ()):
-        if property["key"] == name:
-            return property["value"]
-    return
+def save_response(r: requests.Response, file: Path, append: bool = False):
+    """Write the body of a streamed response to a file, chunk by chunk."""
+    with file.open("ab" if append else "wb") as f:
+        for chunk in r.iter_content(chunk_size=1024 * 1024):
+            if DOWNLOAD_CANCELLED.is_set():
+                # the partial file is kept and can be resumed
+                break
+            f.write(chunk)
+
+
+def download_file(session: requests.Session, url: str, file: Path, timeout=None) -> requests.Response:
+    """
+    Download url to file, through a <file>.part temporary file.
+
+    An interrupted download is resumed with a Range request at the next call.
+    The file is renamed only when the received size matches the announced one.
+    """
+
+    part = file.with_name(file.name + ".part")
+    offset = part.stat().st_size if part.is_file() else 0
+
+    # no Content-Encoding: the range and the Content-Length apply to the bytes written in the file
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
 
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 416:
+            # range not satisfiable: the partial file is unusable, start over
+            part.unlink()
+            return download_file(session, url, file, timeout)
 
+        # do not save an error page as the file
+        r.raise_for_status()
+
+        if r.status_code != 206:
+            # server ignored the range
+            offset = 0
+
+        save_response(r, part, append=offset > 0)
+
+    if DOWNLOAD_CANCELLED.is_set():
+        return r
+
+    length = r.headers.get("Content-Length")
+    if length is not None:
+        if offset + int(length) != part.stat().st_size:
+            logging.debug(f"incomplete download: {part}")
+            return r
+
+    part.replace(file)
+    return r
+
+
+def timestamp_ns(date: datetime) -> int:
+    """POSIX timestamp in nanoseconds, without the rounding errors of a float multiplication."""
+    return int(date.timestamp()) * 1_000_000_000 + date.microsecond * 1000
+
+
+@lru_cache(maxsize=1024)
+def isoformat_ns(timestamp: str) -> int:
+    """POSIX timestamp in nanoseconds of an ISO 8601 date, such as the lastUpdated of the extensions."""
+    # before Python 3.11, fromisoformat supports neither the Z suffix
+    # nor fractions of second other than 3 or 6 digits (the marketplace sends 1 to 7 digits)
+    if timestamp.endswith("Z"):
+        timestamp = timestamp[:-1] + "+00:00"
+    timestamp = _RE_ISO_FRACTION.sub(lambda m: "." + m[1][:6].ljust(6, "0"), timestamp)
+    return timestamp_ns(datetime.fromisoformat(timestamp))
+
+
+def get_properties(version) -> t.Dict[str, t.Any]:
+    """Properties of an extension version, as a dict."""
+    return {property["key"]: property["value"] for property in version.get("properties", ())}
+
+
+@lru_cache(maxsize=None)
 def version_serial(version):
     v = version.split(".", maxsplit=2)
     if "-" in v[2]:
@@ -106,6 +237,7 @@ def version_serial(version):
         return tuple(map(int, v))
 
 
+@lru_cache(maxsize=4096)
 def engine_match(pattern, engine):
     if pattern == "*":
         return True
@@ -162,6 +294,12 @@ class Asset:
     ignore: bool = False
     "Ignore the extension in the inventory."
 
+    name_cf: str = field(init=False, repr=False, compare=False)
+    "Casefolded name, to compare extension identifiers."
+
+    def __post_init__(self):
+        self.name_cf = self.name.casefold()
+
     @property
     def vsix(self) -> str:
         """Filename of the vsix."""
@@ -178,17 +316,13 @@ class Asset:
             return f"{self.name}-*.vsix"
 
 
-def vscode_lldb(asset: Asset, dest_dir: Path) -> t.List[Asset]:
+def vscode_lldb(asset: Asset, m: dict) -> t.List[Asset]:
     """
     vscode-lldb is special: platform packages are downloaded separately.
     """
     assert asset.name == "vadimcn.vscode-lldb"
     assert asset.platform is None
 
-    zip = zipfile.ZipFile(dest_dir / asset.vsix)
-    m = json.loads(zip.open("extension/package.json").read())
-    zip.close()
-
     version = m.get("version")
     platform_packages = m.get("config", {}).get("platformPackages", {})
     url = platform_packages.get("url")
@@ -227,6 +361,31 @@ class Extensions:
         self.write_cache = write_cache
         self.dest_dir = dest_dir
         self.all_assets_list: t.List[Asset] = list()
+        self.requested_vsix: t.Set[str] = set()
+
+        # manifests already read, by vsix filename, with the size and mtime of the vsix
+        self.manifests_file = dest_dir / ".manifests.json"
+        self.manifests: t.Dict[str, dict] = dict()
+        self.manifests_changed = False
+        if self.manifests_file.is_file():
+            try:
+                manifests = json_loads(self.manifests_file.read_bytes())
+            except ValueError:
+                manifests = None
+            if isinstance(manifests, dict):
+                # keep only the well-formed entries
+                self.manifests = {
+                    vsix: entry
+                    for vsix, entry in manifests.items()
+                    if isinstance(entry, dict)
+                    and isinstance(entry.get("mtime_ns"), int)
+                    and isinstance(entry.get("size"), int)
+                    and isinstance(entry.get("manifest"), dict)
+                }
+                self.manifests_changed = len(self.manifests) != len(manifests)
+            else:
+                logging.warning(f"ignore invalid {self.manifests_file}")
+                self.manifests_changed = True
 
     def run(self, extension_ids: t.Iterable[str]):
         """
@@ -235,29 +394,28 @@ class Extensions:
 
         all_assets = dict()
 
-        all_extension_ids = set(extension_ids)  # set of extension identifiers already fetched
-        assets, packs = self.find_assets(extension_ids)
+        wanted_extension_ids = set(map(str.casefold, extension_ids))
+        all_extension_ids = set(wanted_extension_ids)  # set of extension identifiers already fetched
+        assets, packs = self.download_extensions(wanted_extension_ids)
         all_assets.update(assets)
 
-        self.download_vsix_files(assets.values())
-
         # as long we have packs
         while packs:
-            new_extension_ids = set()
-
-            for pack in packs:
-                # load the extension pack manifest (on disk) and get the child extensions
-                zip = zipfile.ZipFile(self.dest_dir / assets[pack].vsix)
-                m = json.loads(zip.open("extension/package.json").read())
-                new_extension_ids.update(m["extensionPack"])
-                zip.close()
+            new_extension_ids: t.Set[str] = set()
+
+            # load the extension pack manifests (on disk) and get the child extensions
+            with ThreadPoolExecutor(max_workers=MANIFEST_WORKERS) as executor:
+                manifests = list(executor.map(self.read_manifest, (assets[pack] for pack in packs)))
+
+            for pack, m in zip(packs, manifests):
+                new_extension_ids.update(map(str.casefold, m["extensionPack"]))
                 logging.debug(f"pack {pack} has {len(m['extensionPack'])} extension(s)")
 
             new_extension_ids.difference_update(all_extension_ids)
+            all_extension_ids.update(new_extension_ids)
 
             # download new found extensions
-            assets, packs = self.find_assets(new_extension_ids)
-            self.download_vsix_files(assets.values())
+            assets, packs = self.download_extensions(new_extension_ids)
 
             all_assets.update(assets)
 
@@ -265,8 +423,7 @@ class Extensions:
 
         for asset in all_assets_list:
             if asset.name == "vadimcn.vscode-lldb":
-                a = vscode_lldb(asset, self.dest_dir)
-                self.download_vsix_files(a)
+                a = self.download_vsix_files(vscode_lldb(asset, self.read_manifest(asset)))
                 asset.ignore = True
                 all_assets_list.extend(a)
                 break
@@ -274,34 +431,95 @@ class Extensions:
         ignored = sum(1 for a in all_assets_list if a.ignore)
         print(f"downloaded vsix: {len(all_assets_list) - ignored}")
 
-        all_extension_ids = set(asset.name.casefold() for asset in all_assets_list)
-        missing = set(map(str.casefold, extension_ids)).difference(all_extension_ids)
+        downloaded_extension_ids = set(asset.name_cf for asset in all_assets_list)
+        missing = wanted_extension_ids - downloaded_extension_ids
         if missing:
             logging.error(f"extensions not found: {missing}")
 
         self.all_assets_list = all_assets_list
 
-    def download_vsix_files(self, assets: t.Iterable[Asset]):
+        self.save_manifests()
+
+    def read_manifest(self, asset: Asset) -> dict:
         """
-        Download extension archive (VSIX).
+        Read the extension manifest (package.json) from the VSIX, unless the VSIX is unchanged since the last read.
         """
 
-        for asset in assets:
-            vsix = self.dest_dir / asset.vsix
-            if not vsix.exists():
-                vsix.parent.mkdir(parents=True, exist_ok=True)
-                print(f"download {vsix}")
+        vsix = self.dest_dir / asset.vsix
+        st = vsix.stat()
+
+        entry = self.manifests.get(asset.vsix)
+        if entry is None or entry["mtime_ns"] != st.st_mtime_ns or entry["size"] != st.st_size:
+            # zipfile only reads the central directory and the requested entry
+            with zipfile.ZipFile(vsix) as zf:
+                m = json_loads(zf.read("extension/package.json"))
+            entry = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "manifest": m}
+            self.manifests[asset.vsix] = entry
+            self.manifests_changed = True
+
+        return entry["manifest"]
+
+    def save_manifests(self):
+        """
+        Write the manifests cache if it has changed, for the VSIX files still present.
+        """
 
-                r = requests.get(asset.uri, timeout=30)
-                vsix.write_bytes(r.content)
+        manifests = {vsix: entry for vsix, entry in self.manifests.items() if (self.dest_dir / vsix).is_file()}
+        if self.manifests_changed or len(manifests) != len(self.manifests):
+            write_file(self.manifests_file, json_dumps(manifests))
+            self.manifests = manifests
+            self.manifests_changed = False
 
-                mtime_ns = int(datetime.fromisoformat(asset.timestamp).timestamp() * 1_000_000_000)
-                os.utime(vsix, ns=(mtime_ns, mtime_ns))
+    def download_extensions(self, extension_ids: t.Iterable[str]) -> t.Tuple[t.Dict[str, Asset], t.Set[str]]:
+        """
+        Find and download extensions. Return the assets available on disk and the packs among them.
+        """
+
+        assets, packs = self.find_assets(extension_ids)
+        assets = {asset.vsix: asset for asset in self.download_vsix_files(assets.values())}
+        return assets, packs.intersection(assets)
+
+    def download_vsix_files(self, assets: t.Iterable[Asset]) -> t.List[Asset]:
+        """
+        Download extension archives (VSIX) concurrently. Return the assets available on disk.
+        """
+
+        assets = list(assets)
+        self.requested_vsix.update(asset.vsix for asset in assets)
+
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            downloaded = list(executor.map(self.download_vsix, assets))
+
+        return [asset for asset, ok in zip(assets, downloaded) if ok]
+
+    def download_vsix(self, asset: Asset) -> bool:
+        """
+        Download extension archive (VSIX). Return False if the download failed.
+        """
+
+        vsix = self.dest_dir / asset.vsix
+        if not vsix.exists():
+            vsix.parent.mkdir(parents=True, exist_ok=True)
+            print(f"download {vsix}")
+
+            try:
+                download_file(SESSION, asset.uri, vsix, timeout=30)
+            except requests.RequestException as e:
+                logging.error(f"download problem {asset.uri}: {e}")
+                return False
+            if not vsix.exists():
+                logging.error(f"download problem {asset.uri}")
+                return False
+
+            mtime_ns = isoformat_ns(asset.timestamp)
+            os.utime(vsix, ns=(mtime_ns, mtime_ns))
+        else:
+            if asset.platform:
+                logging.debug(f"already downloaded: {asset.name} {asset.version} ({asset.platform})")
             else:
-                if asset.platform:
-                    logging.debug(f"already downloaded: {asset.name} {asset.version} ({asset.platform})")
-                else:
-                    logging.debug(f"already downloaded: {asset.name} {asset.version}")
+                logging.debug(f"already downloaded: {asset.name} {asset.version}")
+
+        return True
 
     def find_assets(self, extension_ids: t.Iterable[str]) -> t.Tuple[t.Dict[str, Asset], t.Set[str]]:
         """Build the list of extensions to download."""
@@ -352,23 +570,41 @@ class Extensions:
             # },
         ]
 
-        for extension_id in sorted(extension_ids):
-            criteria.append({"filterType": FilterType.ExtensionName, "value": extension_id})
+        # one filter per batch of extensions to keep each filter small,
+        # the server returns one result per filter
+        names = sorted(extension_ids)
+        filters = []
+        for i in range(0, len(names), QUERY_BATCH_SIZE):
+            batch = [
+                {"filterType": FilterType.ExtensionName, "value": name} for name in names[i : i + QUERY_BATCH_SIZE]
+            ]
+            filters.append({"criteria": criteria + batch})
+
+        flags = Flags.IncludeAssetUri + Flags.IncludeVersionProperties + Flags.IncludeCategoryAndTags
 
         data = {
-            "filters": [{"criteria": criteria}],
-            "flags": Flags.IncludeAssetUri + Flags.IncludeVersionProperties + Flags.IncludeCategoryAndTags,
+            "filters": filters,
+            "flags": flags,
         }
 
         data_str = json.dumps(data)
 
-        hash = f"{zlib.crc32(data_str.encode()):04x}"
-        cache = Path(f"response_{hash}.json")
+        # the cache key only depends on the requested extensions and the flags
+        key = hashlib.blake2b(("|".join(names) + f":{flags}").encode(), digest_size=10).hexdigest()
+        cache_dir = self.dest_dir / ".cache"
+        cache = cache_dir / f"response_{key}.json.gz"
+        legacy_cache = Path(f"response_{zlib.crc32(data_str.encode()):04x}.json")
+
         if cache.is_file():
             logging.info(f"load cached response {cache}")
-            r = json.loads(cache.read_bytes())
+            with gzip.open(cache, "rb") as f:
+                r = json_loads(f.read())
+        elif legacy_cache.is_file():
+            # cache file written by older versions (CRC-32 of the query, in the current directory)
+            logging.info(f"load cached response {legacy_cache}")
+            r = json_loads(legacy_cache.read_bytes())
         else:
-            resp = requests.post(
+            resp = SESSION.post(
                 "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery",
                 data=data_str,
                 headers={
@@ -378,10 +614,11 @@ class Extensions:
                 timeout=10,
             )
             if self.write_cache:
-                Path(f"query_{hash}.json").write_text(data_str)
-                cache.write_bytes(resp.content)
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                (cache_dir / f"query_{key}.json").write_text(data_str)
+                write_file(cache, gzip.compress(resp.content, compresslevel=1))
                 logging.debug(f"write query and response {cache}")
-            r = resp.json()
+            r = json_loads(resp.content)
 
         return r
 
@@ -433,7 +670,8 @@ class Extensions:
 
         name = extension["publisher"]["publisherName"] + "." + extension["extensionName"]
 
-        def filter_version(extension, platform):
+        def filter_version(extension):
+            """Yield the usable versions with their target platform (None if universal)."""
             has_target_platform = set()
 
             for version in extension["versions"]:
@@ -443,65 +681,68 @@ class Extensions:
                     print(json.dumps(version, indent=2))
                     exit()
 
+                properties = get_properties(version)
+
                 # do not use pre-release version
-                v = get_property(version, "Microsoft.VisualStudio.Code.PreRelease")
+                v = properties.get("Microsoft.VisualStudio.Code.PreRelease")
                 if v == "true":
                     continue
 
                 # we have to match the engine version
-                v = get_property(version, "Microsoft.VisualStudio.Code.Engine")
+                v = properties.get("Microsoft.VisualStudio.Code.Engine")
                 if not (v and engine_match(v, self.engine)):
                     continue
 
-                if version.get("targetPlatform") is not None:
-                    assert version["targetPlatform"] in PLATFORMS
+                target_platform = version.get("targetPlatform")
+                if target_platform is not None:
+                    assert target_platform in PLATFORMS
                     has_target_platform.add(version["version"])
-
-                # we have to match the platform if asked and specified for the version
-                if version["version"] in has_target_platform and platform and version.get("targetPlatform") != platform:
+                elif version["version"] in has_target_platform:
+                    # this version has platform specific packages
                     continue
 
-                yield version
+                yield target_platform, version
+
+        def find_latest_version(versions):
+            return max(versions, key=lambda v: version_serial(v["version"]), default=None)
+
+        # partition the versions once: universal ones (None) are shared by all platforms
+        platform_versions = defaultdict(list)
+        for target_platform, version in filter_version(extension):
+            platform_versions[target_platform].append(version)
 
-        def find_latest_version(extension, platform):
-            versions = filter_version(extension, platform)
-            versions = sorted(versions, key=lambda v: version_serial(v["version"]))
-            if versions:
-                return versions[-1]
+        universal_version = find_latest_version(platform_versions[None])
 
-        def find_version_vsix(extension: dict, platform: str) -> t.Optional[Asset]:
-            version = find_latest_version(extension, platform)
+        assets = dict()
+
+        for target_platform, wanted in PLATFORMS.items():
+            if not wanted:
+                continue
 
+            candidates = (find_latest_version(platform_versions[target_platform]), universal_version)
+            version = find_latest_version(v for v in candidates if v)
             if not version:
-                logging.error(f"missing {platform} for {name}")
-                return None
-            asset_uri = version["assetUri"] + "/Microsoft.VisualStudio.Services.VSIXPackage"
-            target_platform = version.get("targetPlatform")
+                logging.error(f"missing {target_platform} for {name}")
+                continue
 
             asset = Asset(
                 name,
                 version["version"],
-                get_property(version, "Microsoft.VisualStudio.Code.Engine"),
-                asset_uri,
+                get_properties(version)["Microsoft.VisualStudio.Code.Engine"],  # checked by filter_version
+                version["assetUri"] + "/Microsoft.VisualStudio.Services.VSIXPackage",
                 version["lastUpdated"],
-                target_platform,
+                version.get("targetPlatform"),
             )
-
-            return asset
-
-        assets = dict()
-
-        for target_platform, wanted in PLATFORMS.items():
-            if wanted:
-                asset = find_version_vsix(extension, target_platform)
-                if asset:
-                    assets[asset.vsix] = asset
+            assets[asset.vsix] = asset
 
         return assets
 
     def prune(self):
         all_vsix = set(file.name for file in self.dest_dir.glob("*.vsix"))
+        all_vsix.update(file.name for file in self.dest_dir.glob("*.vsix.part"))
         our_vsix = set(asset.vsix for asset in self.all_assets_list)
+        # keep the partial downloads of the wanted extensions, they will be resumed
+        our_vsix.update(f"{vsix}.part" for vsix in self.requested_vsix)
 
         for file in all_vsix.difference(our_vsix):
             logging.debug(f"purge {file}")
@@ -519,13 +760,13 @@ def get_code_version(version: str, channel="stable"):
 
     # url = f"https://code.visualstudio.com/sha/download?build={channel}&os=win32-x64-archive"
 
-    r = requests.get(url, allow_redirects=False, timeout=10)
+    r = SESSION.get(url, allow_redirects=False, timeout=10)
     if r is None or r.status_code != 302:
         logging.fatal(f"request error {r}")
         exit(2)
 
     url = r.headers["Location"]
-    m = re.search(r"/(\w+)/([a-f0-9]{40})/VSCode-win32-x64-([\d.]+).zip", url)
+    m = _RE_CODE_URL.search(url)
     if not m or m[1] != channel:
         logging.fatal(f"cannot extract vscode version from url {url}")
         exit(2)
@@ -540,17 +781,17 @@ def get_code_version(version: str, channel="stable"):
 def read_code_version(files: Path) -> CodeVersion:
     assets = files.read_text()
 
-    m_version = re.search(r"\bversion=(.+)\b", assets)
+    m_version = _RE_VERSION.search(assets)
     if not m_version:
         logging.error(f"Version not found in {files}")
         exit(1)
 
-    m_commit = re.search(r"\bcommit=(.+)\b", assets)
+    m_commit = _RE_COMMIT.search(assets)
     if not m_commit:
         logging.error(f"Commit not found in {files}")
         exit(1)
 
-    m_channel = re.search(r"\bchannel=(.+)\b", assets)
+    m_channel = _RE_CHANNEL.search(assets)
     if not m_channel:
         logging.error(f"Channel not found in {files}")
         exit(1)
@@ -558,15 +799,16 @@ def read_code_version(files: Path) -> CodeVersion:
     return CodeVersion(m_version[1], m_commit[1], m_channel[1])
 
 
-def get_installed_extensions() -> t.List[str]:
+@lru_cache(maxsize=1)
+def get_installed_extensions() -> t.Tuple[str, ...]:
     """
-    List the installed extensions.
+    List the installed extensions (the code CLI is run only once).
     """
     try:
         output = subprocess.check_output(["code", "--list-extensions"])  # nosec B603 B607
-        return output.decode().splitlines()
+        return tuple(output.decode().splitlines())
     except Exception:
-        return []
+        return ()
 
 
 def compare_local(extension_ids: t.Iterable[str]):
@@ -577,14 +819,15 @@ def compare_local(extension_ids: t.Iterable[str]):
     set_wanted = set(extension_ids)
 
     # check the case
-    set_installed_lowercase = set(map(str.lower, set_installed))
+    installed_casefold = defaultdict(list)
+    for j in set_installed:
+        installed_casefold[j.casefold()].append(j)
     for i in set_wanted:
         if i in set_installed:
             continue
-        if i.casefold() in set_installed_lowercase:
-            for j in set_installed:
-                if j.casefold() == i.casefold():
-                    logging.warning(f"Upper/lower case problem with {i}, should be {j}")
+        if i.casefold() in installed_casefold:
+            for j in installed_casefold[i.casefold()]:
+                logging.warning(f"Upper/lower case problem with {i}, should be {j}")
             return 2
 
     set3 = set_wanted.union(set_installed)
@@ -624,22 +867,25 @@ class Config:
         # read extension list from configuration file
         self.sections = defaultdict(set)
 
+        # content of the configuration file, if any
+        self.path = assets_file
+        self.raw_text: t.Optional[str] = None
+
         if assets_file and assets_file.is_file():
             print(f"reading configuration from: {assets_file}")
             files = assets_file.read_text()
-            for section, extension_list in re.findall(r"(\w+_extensions)=\((.+?)\)", files, flags=re.DOTALL):
+            self.raw_text = files
+            for section, extension_list in _RE_SECTION.findall(files):
                 for name in extension_list.splitlines():
                     name = name.strip()
                     if not name or name.startswith("#"):
                         continue
 
                     # remove platform
-                    name = name.replace("-${arch}", "")
-                    for platform in PLATFORMS.keys():
-                        name = name.replace(f"-{platform}", "")
+                    name = _RE_PLATFORM_STRIP.sub("", name)
 
                     # remove version
-                    name = re.sub(r"\-(\d+)\.(\d+)\.(\d+)\.vsix$", "", name)
+                    name = _RE_VSIX_VERSION.sub("", name)
 
                     # lower case
                     name = name.casefold()
@@ -663,48 +909,62 @@ class Config:
         return self.sections["all_extensions"]
 
 
-def write_extension_assets(assets_file: Path, config: Config, assets: t.List[Asset]):
+def write_file(file: Path, data: t.Union[str, bytes]):
+    """
+    Write a text or binary file atomically: an interrupted write does not leave a truncated file.
+    """
+    tmp = file.with_suffix(".tmp")
+    if isinstance(data, str):
+        tmp.write_text(data)
+    else:
+        tmp.write_bytes(data)
+    os.replace(tmp, file)
+
+
+def write_extension_assets(assets_file: Path, config: Config, assets: t.List[Asset], text: t.Optional[str] = None):
+    """
+    Write the extension sections of the inventory. text is the current content of the file, if already known.
+    """
     group_by_platform = False
 
+    # index the assets by extension identifier, sorted by platform
+    by_name: t.Dict[str, t.List[Asset]] = defaultdict(list)
+    platform_versions: t.Dict[str, t.Set[str]] = defaultdict(set)
+    for asset in sorted(assets, key=lambda asset: str(asset.platform)):
+        if asset.ignore:
+            continue
+        by_name[asset.name_cf].append(asset)
+        if asset.platform:
+            platform_versions[asset.name_cf].add(asset.version)
+
     def make_section(vsix: str) -> str:
-        with StringIO() as f:
-            extension_list = config.sections.get(vsix)
-            if extension_list:
-                print(f"{vsix}=(", file=f)
-
-                for name in sorted(extension_list, key=str.casefold):
-                    # all target platforms may not be in same version
-                    all_platforms_same_version = 1 == len(
-                        set(
-                            asset.version
-                            for asset in assets
-                            if asset.platform and not asset.ignore and name.casefold() == asset.name.casefold()
-                        )
-                    )
-
-                    for asset in sorted(assets, key=lambda asset: str(asset.platform)):
-                        if asset.ignore or name.casefold() != asset.name.casefold():
-                            continue
-
-                        vsix = asset.vsix
-                        if asset.platform and all_platforms_same_version and group_by_platform:
-                            vsix = vsix.replace(asset.platform, "${arch}")
-                            print(f"  {vsix}", file=f)
-                            break
-                        else:
-                            print(f"  {vsix}", file=f)
-
-                print(")", file=f, end="")
-
-            return f.getvalue()
-
-    if assets_file.is_file():
-        inventory = re.sub(
-            r"\b\w+_extensions=\((?:.+?)\)",
-            "",
-            assets_file.read_text(),
-            flags=re.DOTALL,
-        )
+        lines = []
+        extension_list = config.sections.get(vsix)
+        if extension_list:
+            lines.append(f"{vsix}=(")
+
+            for name in sorted(map(str.casefold, extension_list)):
+                # all target platforms may not be in same version
+                all_platforms_same_version = 1 == len(platform_versions.get(name, ()))
+
+                for asset in by_name.get(name, ()):
+                    vsix = asset.vsix
+                    if asset.platform and all_platforms_same_version and group_by_platform:
+                        vsix = vsix.replace(asset.platform, "${arch}")
+                        lines.append(f"  {vsix}")
+                        break
+                    else:
+                        lines.append(f"  {vsix}")
+
+            lines.append(")")
+
+        return "\n".join(lines)
+
+    if text is None and assets_file.is_file():
+        text = assets_file.read_text()
+
+    if text is not None:
+        inventory = _RE_INVENTORY.sub("", text)
         inventory = inventory.strip() + "\n\n"
     else:
         inventory = ""
@@ -717,7 +977,7 @@ def write_extension_assets(assets_file: Path, config: Config, assets: t.List[Ass
     # if assets_file.is_file():
     #     assets_file.rename(old)
 
-    assets_file.write_text(inventory)
+    write_file(assets_file, inventory)
 
     # for i, z in enumerate(sorted(config.all_extensions), 1):
     #     print(i, z)
@@ -725,8 +985,13 @@ def write_extension_assets(assets_file: Path, config: Config, assets: t.List[Ass
     print(f"extensions: {len(config.all_extensions)}")
 
 
-def write_code_assets(assets_file: Path, assets: t.Dict[str, str]):
-    if assets_file.is_file():
+def write_code_assets(assets_file: Path, assets: t.Dict[str, str], text: t.Optional[str] = None) -> str:
+    """
+    Write the code archives in the inventory. text is the current content of the file, if already known.
+    """
+    if text is not None:
+        config = text
+    elif assets_file.is_file():
         config = assets_file.read_text()
     else:
         config = ""
@@ -735,11 +1000,10 @@ def write_code_assets(assets_file: Path, assets: t.Dict[str, str]):
     for k, v in assets.items():
         new_config.append(f"{k}={v}")
 
+    # keep the lines that do not define one of the assets
+    prefixes = tuple(f"{k}=" for k in assets.keys())
     for line in config.splitlines():
-        for k in assets.keys():
-            if line.lstrip().startswith(f"{k}="):
-                break
-        else:
+        if not line.lstrip().startswith(prefixes):
             new_config.append(line)
 
     config = "\n".join(new_config) + "\n"
@@ -750,7 +1014,9 @@ def write_code_assets(assets_file: Path, assets: t.Dict[str, str]):
     # if config_file.is_file():
     #     config_file.rename(old)
 
-    assets_file.write_text(config)
+    write_file(assets_file, config)
+
+    return config
 
 
 def get_version_dest_dir(engine: t.Optional[str], dest_dir: t.Optional[Path]) -> t.Tuple[CodeVersion, Path]:
@@ -785,36 +1051,60 @@ def get_version_dest_dir(engine: t.Optional[str], dest_dir: t.Optional[Path]) ->
     return version, dest_dir
 
 
-def download_code(dest_dir: Path, url: str) -> str:
-    session = requests.Session()
+def sha256sum(file: Path) -> str:
+    """Compute the SHA-256 digest of a file without loading it into memory."""
+
+    with file.open("rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+: reads into a reusable buffer
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+        h = hashlib.sha256()
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+        return h.hexdigest()
+
+
+class DownloadError(Exception):
+    """Failed download of a code archive, with the exit code of the program."""
 
-    r = session.head(url)
+    def __init__(self, message: str, exit_code: int = 2):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+def download_code(dest_dir: Path, url: str) -> str:
+    r = SESSION.head(url)
     if "Location" not in r.headers:
-        print("no Location header:", url, r)
-        exit(1)
+        raise DownloadError(f"no Location header: {url} {r}", 1)
 
     real_url = r.headers["Location"]
+    digest = r.headers["X-SHA256"]
     filename = Path(real_url).name
     file = dest_dir / filename
 
     if file.is_file():
-        digest = hashlib.sha256(file.read_bytes()).hexdigest()
-        if digest != r.headers["X-SHA256"]:
+        if sha256sum(file) != digest:
             file.unlink()
 
     if not file.is_file():
         file.parent.mkdir(parents=True, exist_ok=True)
         print(f"downloading {file}")
-        r = session.get(real_url)
-        file.write_bytes(r.content)
+        try:
+            r = download_file(SESSION, real_url, file)
+        except requests.RequestException as e:
+            raise DownloadError(f"download problem {url}: {e}")
 
-        if int(r.headers["Content-Length"]) != file.stat().st_size:
+        if not file.is_file():
+            # the partial download is kept and will be resumed at the next run
+            raise DownloadError(f"download problem {url}")
+
+        if sha256sum(file) != digest:
+            # e.g. a partial download of another build (same file name) completed with this one
             file.unlink()
-            print(f"download problem {url}")
-            exit(2)
+            raise DownloadError(f"download problem {url}: SHA-256 mismatch")
 
         url_date = parsedate_to_datetime(r.headers["Last-Modified"])
-        mtime = round(url_date.timestamp() * 1_000_000_000)
+        mtime = timestamp_ns(url_date)
         os.utime(file, ns=(mtime, mtime))
     else:
         print(f"already downloaded: {filename}")
@@ -848,8 +1138,23 @@ def download_code_assets(code: CodeVersion, dest_dir: Path) -> t.Dict[str, str]:
         # "cli_linux_alpine": f"https://update.code.visualstudio.com/{version}/cli-alpine-x64/{channel}",
     }
 
-    for name, url in urls.items():
-        assets[name] = download_code(dest_dir, url)
+    # each worker verifies the SHA-256 of an already present archive or downloads it:
+    # hashlib releases the GIL, so verifications run in parallel too
+    filenames = dict()
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = {executor.submit(download_code, dest_dir, url): name for name, url in urls.items()}
+        try:
+            for future in as_completed(futures):
+                filenames[futures[future]] = future.result()
+        except DownloadError as e:
+            # do not wait for the other archives: cancel the pending ones and interrupt the running ones
+            print(e)
+            DOWNLOAD_CANCELLED.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            exit(e.exit_code)
+
+    # keep the order of urls in the inventory
+    assets.update((name, filenames[name]) for name in urls)
 
     return assets
 
@@ -878,8 +1183,13 @@ def main():
 
     set_verbosity(args.verbose)
 
-    # get the version and destination
-    version, dest_dir = get_version_dest_dir(args.version, args.dest_dir)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # the code CLI is slow to start: list the local extensions while getting the version
+        if args.local or args.compare_local:
+            executor.submit(get_installed_extensions)
+
+        # get the version and destination
+        version, dest_dir = get_version_dest_dir(args.version, args.dest_dir)
 
     if not args.config:
         args.config = Path("vscode-offline.conf")
@@ -892,10 +1202,13 @@ def main():
     if args.compare_local:
         exit(compare_local(config.all_extensions))
 
+    # content of the inventory, to avoid reading it again if it is also the configuration file
+    inventory = config.raw_text if config.path == dest_dir / "files" else None
+
     # code and code-server
     if not args.extensions_only:
         assets = download_code_assets(version, dest_dir)
-        write_code_assets(dest_dir / "files", assets)
+        inventory = write_code_assets(dest_dir / "files", assets, inventory)
 
     # extensions
     exts = Extensions(version.version, dest_dir, args.verbose)
@@ -904,7 +1217,7 @@ def main():
     if args.prune:
         exts.prune()
 
-    write_extension_assets(dest_dir / "files", config, exts.assets())
+    write_extension_assets(dest_dir / "files", config, exts.assets(), inventory)
 
 
 if __name__ == "__main__":